@@ -10,40 +10,131 @@ List of functions:
     get_user
     send_message
     send_message_history
+    flush_pending
     event_loop
 
 List of constants:
     HOST
     PORT
+    FLUSH_INTERVAL
+    FLUSH_THRESHOLD
+    MAX_PENDING
+    HISTORY_SIZE
 
 List of variables:
-    users
+    users_by_fd
+    pending
+    broadcast_buffers
     message_history
     count_of_clients
     server_socket
 """
 
 import logging
-from dataclasses import dataclass
-from selectors import EVENT_READ, DefaultSelector
-from socket import socket
+import math
+import select
+from collections import deque
+from dataclasses import dataclass, field
+from selectors import EVENT_READ, EVENT_WRITE, BaseSelector, DefaultSelector
+from socket import IPPROTO_TCP, TCP_NODELAY, socket
+from time import monotonic
 from typing import Callable
 
 HOST: str = ''
 PORT: int = 9090
 
-_names: list[str] = ["John", "Jill", "Smith", "Bella"]
-users: list["User"] = []
-sent_messages: list["Message"] = []
+# Broadcasts are queued and sent to clients at most once per FLUSH_INTERVAL,
+# or right away once FLUSH_THRESHOLD bytes are queued since the last flush
+FLUSH_INTERVAL: float = 0.05
+FLUSH_THRESHOLD: int = 8192
+
+# Client with more unsent bytes is disconnected. Must fit greeting and
+# whole history, which are up to HISTORY_SIZE messages of 4096 bytes
+MAX_PENDING: int = 4 * 1024 * 1024
+
+# Only this number of last messages is kept and sent to new users
+HISTORY_SIZE: int = 500
+
+_names: deque[str] = deque(["John", "Jill", "Smith", "Bella"])
+# Same names as in _names, for O(1) membership test
+_names_set: set[str] = set(_names)
+users_by_fd: dict[int, "User"] = {}
+pending: dict[int, bytearray] = {}
+# Same buffers as in pending, so broadcast streams over a flat list
+broadcast_buffers: list[bytearray] = []
+# Index of buffer of every client in broadcast_buffers, and file
+# descriptor of client of every buffer, for O(1) removal
+_broadcast_index: dict[int, int] = {}
+_broadcast_fds: list[int] = []
+sent_messages: deque["Message"] = deque(maxlen=HISTORY_SIZE)
+# Messages dropped from sent_messages, reused for new messages
+_message_pool: list["Message"] = []
+# Encoded sent_messages, ready to be sent to new users as is
+_history_blob: bytearray = bytearray()
+_history_sizes: deque[int] = deque(maxlen=HISTORY_SIZE)
 count_of_clients: int = len(_names)
 
 server_socket: socket = socket()
 
-_connection_selector = DefaultSelector()
-_get_message_selector = DefaultSelector()
-
-
-@dataclass
+# Clients which failed, disconnected by event loop once keys are handled
+_dead_sockets: set[socket] = set()
+
+_queued_bytes: int = 0
+_last_flush: float = 0.0
+
+if hasattr(select, "epoll"):
+    from selectors import EpollSelector
+
+    _NOT_EPOLLIN = ~select.EPOLLIN
+    _NOT_EPOLLOUT = ~select.EPOLLOUT
+
+    class _EpollSelector(EpollSelector):
+        """
+        EpollSelector with cheaper select.
+
+        Event masks are precomputed and max_ev is computed without max()
+        """
+
+        def select(self, timeout=None):
+            if timeout is None:
+                timeout = -1
+            elif timeout <= 0:
+                timeout = 0
+            else:
+                # epoll_wait() has a resolution of 1 millisecond, round away
+                # from zero to wait *at least* timeout seconds.
+                timeout = math.ceil(timeout * 1e3) * 1e-3
+
+            fd_to_key = self._fd_to_key
+            ready = []
+            try:
+                fd_event_list = self._selector.poll(
+                    timeout,
+                    len(fd_to_key) or 1
+                )
+            except InterruptedError:
+                return ready
+            for fd, event in fd_event_list:
+                events = 0
+                if event & _NOT_EPOLLIN:
+                    events |= EVENT_WRITE
+                if event & _NOT_EPOLLOUT:
+                    events |= EVENT_READ
+
+                key = fd_to_key.get(fd)
+                if key:
+                    ready.append((key, events & key.events))
+            return ready
+
+    _selector_cls: type[BaseSelector] = _EpollSelector
+else:
+    _selector_cls = DefaultSelector
+
+# One selector serves both server socket and client sockets
+_selector = _selector_cls()
+
+
+@dataclass(slots=True)
 class User:
     """
     User stores information about connected user.
@@ -51,6 +142,7 @@ class User:
     List of fields:
         client_socket
         name
+        name_prefix
 
     List of methods:
         del_self
@@ -58,9 +150,14 @@ class User:
 
     client_socket: socket
     name: str
+    # Encoded "name:", put before every message of user
+    name_prefix: bytes = field(init=False)
+
+    def __post_init__(self):
+        self.name_prefix = f"{self.name}:".encode()
 
 
-@dataclass
+@dataclass(slots=True)
 class Message:
     """
     Message stores information about message.
@@ -70,11 +167,11 @@ class Message:
         sender
     """
 
-    body: str
+    body: bytes
     sender: User
 
 
-@dataclass
+@dataclass(slots=True)
 class _Handler:
     """
     _Handler stores information about handler.
@@ -90,45 +187,83 @@ class _Handler:
 
 def _accept_connection():
     """
-    Procedure to accept connection.
+    Procedure to accept connections.
+
+    Procedure accepts all pending connections, until server socket has none
+    left, and connects every of them with _connect_client. Server socket must
+    be non-blocking
+
+    :return:
+    """
+    while True:
+        yield
+        while True:
+            try:
+                client_socket, _ = server_socket.accept()
+            except BlockingIOError:
+                break
+            _connect_client(client_socket)
+
+
+def _connect_client(client_socket: socket) -> None:
+    """
+    Procedure to connect client.
 
-    Procedure accepts connection, creates and connects user, send user some messages
+    Procedure creates and connects user, send user some messages
     and then creates handler for reading messages
 
     Side effects:
-        new user will append in users
+        new user will be added in users_by_fd
         client_socket will be register in selector
 
     Error occur, when server is full. User will get message about it
 
-    :return:
+    :param client_socket: accepted client socket
+    :return: None
     """
-    while True:
-        yield
-        client_socket: socket
-        client_socket, _ = server_socket.accept()
-
-        # Handle no free positions case
-        if not check_free_positions():
+    # Handle no free positions case
+    if not check_free_positions():
+        try:
             send_message(
                 client_socket,
                 "Server is full. You will disconnect\n"
             )
-            logging.info("Got new connection, but server is full")
-            client_socket.close()
-            continue
-
-        new_user = _create_user(client_socket)
-        users.append(new_user)
-
-        send_message(client_socket, f"Your name: {new_user.name}\n")
-        send_message_history(client_socket)
-
-        # Subscribe on read socket event
-        get_message = _get_message(client_socket)
-        handler = _Handler(next, [get_message])
-        _get_message_selector.register(client_socket, EVENT_READ, data=handler)
+        except OSError:
+            pass
+        logging.info("Got new connection, but server is full")
+        client_socket.close()
+        return
+
+    # Writes are already batched by flush_pending, so Nagle's algorithm
+    # would only delay them
+    client_socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    # Slow client must not block sending to others
+    client_socket.setblocking(False)
+
+    new_user = _create_user(client_socket)
+    users_by_fd[client_socket.fileno()] = new_user
+
+    buffer = bytearray()
+    pending[client_socket.fileno()] = buffer
+    _broadcast_index[client_socket.fileno()] = len(broadcast_buffers)
+    broadcast_buffers.append(buffer)
+    _broadcast_fds.append(client_socket.fileno())
+
+    # Subscribe on read socket event
+    get_message = _get_message(client_socket)
+    handler = _Handler(next, [get_message])
+    _selector.register(client_socket, EVENT_READ, data=handler)
+
+    send_message_history(
+        client_socket,
+        greeting=f"Your name: {new_user.name}\n"
+    )
+    # Client failed while getting history, event loop disconnects it
+    if client_socket in _dead_sockets:
+        return
 
+    # getpeername is a syscall, skip it when info isn't logged
+    if logging.getLogger().isEnabledFor(logging.INFO):
         logging.info(
             "Accepted new connection. Places left: %d",
             len(_names)
@@ -150,12 +285,13 @@ def _create_user(client_socket: socket) -> User:
     Create user from client_socket.
 
     Side effects:
-        Pop name from _names
+        Pop name from _names and _names_set
 
     :param client_socket:
     :return:
     """
     name = _names.pop()
+    _names_set.discard(name)
     user = User(
         client_socket=client_socket,
         name=name
@@ -167,6 +303,8 @@ def send_message(client_socket: socket, message: str) -> None:
     """
     Send message to client.
 
+    Used for one-off messages, broadcasts go through pending instead
+
     :param client_socket: client for getting message.
     :param message: message to send
     :return: None
@@ -174,15 +312,59 @@ def send_message(client_socket: socket, message: str) -> None:
     client_socket.send(message.encode())
 
 
-def send_message_history(client_socket: socket) -> None:
+def send_message_history(client_socket: socket, greeting: str = "") -> None:
     """
     Send message history to client.
 
+    Greeting and whole history are put in buffer of pending messages and
+    sent right away. Client socket must be registered in selector
+
     :param client_socket: client for getting message history
+    :param greeting: message to send before history
+    :return: None
+    """
+    buffer = pending[client_socket.fileno()]
+    buffer += greeting.encode()
+    buffer += _history_blob
+    _write_pending(client_socket, buffer)
+
+
+def _add_to_history(message: Message, payload: bytes) -> None:
+    """
+    Append message to history.
+
+    Side effects:
+        The oldest message is dropped and put in _message_pool, when
+        history is full
+
+    :param message: message to append
+    :param payload: encoded message, as it is sent to users
     :return: None
     """
-    for message in sent_messages:
-        send_message(client_socket, f"{message.sender.name}:{message.body}")
+    if len(sent_messages) == HISTORY_SIZE:
+        del _history_blob[:_history_sizes[0]]
+        _message_pool.append(sent_messages[0])
+
+    sent_messages.append(message)
+    _history_sizes.append(len(payload))
+    _history_blob.extend(payload)
+
+
+def _new_message(body: bytes, sender: User) -> Message:
+    """
+    Create message, reusing one from _message_pool if possible.
+
+    :param body: body of message
+    :param sender: user who sent message
+    :return: message
+    """
+    if not _message_pool:
+        return Message(body, sender)
+
+    message = _message_pool.pop()
+    message.body = body
+    message.sender = sender
+    return message
 
 
 def _get_message(client_socket: socket):
@@ -195,9 +377,15 @@ def _get_message(client_socket: socket):
     :param client_socket:
     :return:
     """
+    global _queued_bytes
+
     while True:
         yield
-        message_str = client_socket.recv(4096)
+        try:
+            message_str = client_socket.recv(4096)
+        except OSError:
+            # Reset connection is handled as disconnect
+            message_str = b""
 
         if not message_str:
             _disconnect_socket(client_socket)
@@ -209,20 +397,40 @@ def _get_message(client_socket: socket):
             _disconnect_socket(client_socket)
             return
 
-        message = Message(message_str.decode(), user)
-        sent_messages.append(message)
+        # Message is sent as received, without decoding
+        payload = user.name_prefix + message_str
+        _add_to_history(_new_message(message_str, user), payload)
 
-        for user_in_list in users:
-            send_message(
-                user_in_list.client_socket,
-                f"{user.name}:{message_str.decode()}"
-            )
+        overflow = False
+        for buffer in broadcast_buffers:
+            buffer.extend(payload)
+            if len(buffer) > MAX_PENDING:
+                overflow = True
+        if overflow:
+            _drop_slow_clients()
+        _queued_bytes += len(payload)
+
+        if _queued_bytes >= FLUSH_THRESHOLD:
+            flush_pending()
 
         logging.info("Message got")
 
 
+def _drop_slow_clients() -> None:
+    """
+    Put clients with more than MAX_PENDING unsent bytes in _dead_sockets.
+
+    :return: None
+    """
+    for fd, buffer in pending.items():
+        client_socket = users_by_fd[fd].client_socket
+        if len(buffer) > MAX_PENDING and client_socket not in _dead_sockets:
+            logging.info("Client has too many unsent bytes")
+            _dead_sockets.add(client_socket)
+
+
 def _unsubscribe_socket(client_socket: socket):
-    _get_message_selector.unregister(client_socket)
+    _selector.unregister(client_socket)
     client_socket.close()
 
 
@@ -246,58 +454,142 @@ def get_user(client_socket: socket) -> User:
     """
     Get user from socket.
 
-    User is searched in users
+    User is looked up in users_by_fd by socket file descriptor
 
     :param client_socket: socket object for search
     :raises: ValueError if user doesn't exist
-    :return: searched user or None
+    :return: searched user
     """
-    for user in users:
-        if user.client_socket == client_socket:
-            return user
-
-    raise ValueError("No user found")
+    try:
+        return users_by_fd[client_socket.fileno()]
+    except KeyError:
+        raise ValueError("No user found") from None
 
 
 def del_user(user: User) -> None:
     """
     Delete user.
 
-    Deletes user from users, returns name in _names_list, and closed client
-    socket
+    Deletes user from users_by_fd and drops buffer of messages pending for
+    user in O(1). Must be called before client socket is closed, because
+    user is keyed by socket file descriptor
     """
-    try:
-        users.remove(user)
-    except ValueError:
-        pass
+    fd = user.client_socket.fileno()
+    users_by_fd.pop(fd, None)
+
+    pending.pop(fd, None)
+    index = _broadcast_index.pop(fd, None)
+    if index is None:
+        return
+
+    # Move the last buffer in place of deleted one
+    last_buffer = broadcast_buffers.pop()
+    last_fd = _broadcast_fds.pop()
+    if index < len(broadcast_buffers):
+        broadcast_buffers[index] = last_buffer
+        _broadcast_fds[index] = last_fd
+        _broadcast_index[last_fd] = index
 
 
 def return_name(name: str):
-    if name not in _names:
-        _names.insert(0, name)
+    if name not in _names_set:
+        _names.appendleft(name)
+        _names_set.add(name)
+
+
+def flush_pending() -> None:
+    """
+    Send pending messages to clients.
+
+    Every client gets all of its pending messages with one send call
+
+    :return: None
+    """
+    global _queued_bytes, _last_flush
+
+    for fd, buffer in pending.items():
+        client_socket = users_by_fd[fd].client_socket
+        if buffer and client_socket not in _dead_sockets:
+            _write_pending(client_socket, buffer)
+
+    _queued_bytes = 0
+    _last_flush = monotonic()
+
+
+def _write_pending(client_socket: socket, buffer: bytearray) -> None:
+    """
+    Send as much of buffer as client socket accepts without blocking.
+
+    Side effects:
+        Sent bytes are removed from buffer
+        While buffer isn't empty, client socket is watched for write event
+        Client socket is put in _dead_sockets, if send fails
+
+    :param client_socket: socket to send to
+    :param buffer: pending messages of client
+    :return: None
+    """
+    try:
+        sent = client_socket.send(buffer)
+    except BlockingIOError:
+        sent = 0
+    except OSError:
+        logging.info("Failed to send to client")
+        _dead_sockets.add(client_socket)
+        return
+    del buffer[:sent]
+
+    events = EVENT_READ | EVENT_WRITE if buffer else EVENT_READ
+    key = _selector.get_key(client_socket)
+    if key.events != events:
+        _selector.modify(client_socket, events, data=key.data)
 
 
 def event_loop() -> None:
     """
     Run event loop.
 
+    Pending messages are flushed not later than FLUSH_INTERVAL after they
+    were queued. Clients in _dead_sockets are disconnected after every
+    select
+
     :return: None
     """
     while True:
-        connection_keys = _connection_selector.select(0.5)
-        for key, _ in connection_keys:
-            func = key.data.function
-            func(*key.data.args)
-
-        get_message_keys = _get_message_selector.select(1)
-        for key, _ in get_message_keys:
-            func = key.data.function
-            func(*key.data.args)
+        # Block until some socket is ready, unless messages wait for flush
+        keys = _selector.select(FLUSH_INTERVAL if _queued_bytes else None)
+        for key, events in keys:
+            if key.fileobj in _dead_sockets:
+                continue
+
+            # Write first, read handler may disconnect the socket
+            if events & EVENT_WRITE:
+                _write_pending(key.fileobj, pending[key.fd])
+                if key.fileobj in _dead_sockets:
+                    continue
+            if events & EVENT_READ:
+                func = key.data.function
+                try:
+                    func(*key.data.args)
+                except StopIteration:
+                    # Handler of disconnected client is finished
+                    pass
+
+        if _queued_bytes and monotonic() - _last_flush >= FLUSH_INTERVAL:
+            flush_pending()
+
+        # Failed clients are disconnected here, so no handler or flush
+        # sees half removed client
+        for client_socket in _dead_sockets:
+            _disconnect_socket(client_socket)
+        _dead_sockets.clear()
 
 
 if __name__ == "__main__":
     server_socket.bind(("0.0.0.0", PORT))
     server_socket.listen(count_of_clients)
+    # Accept handler drains all pending connections until accept would block
+    server_socket.setblocking(False)
 
     logging.basicConfig(level=logging.INFO)
 
@@ -306,7 +598,7 @@ if __name__ == "__main__":
 
     accept = _accept_connection()
 
-    _connection_selector.register(
+    _selector.register(
         server_socket,
         EVENT_READ,
         data=_Handler(next, [accept])